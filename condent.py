@@ -1,6 +1,15 @@
-from collections import namedtuple
+from collections import Counter, deque, namedtuple
+import ctypes
+import ctypes.util
 import itertools
+import json
+import os
 import re
+import select
+import struct
+import sys
+import threading
+import time
 
 
 __version__ = "0.4dev"
@@ -10,11 +19,16 @@ DELIMITERS = {"{" : "}", "[" : "]", "(" : ")"}
 
 
 class Condenter(object):
-    def __init__(self, builder, config):
+    def __init__(self, builder, config, stream=True):
         self.builder = builder
         self.config = config
         self.stack = []
 
+        self.stream = stream
+        self.streaming = None
+        self.buffered = 0
+        self.threshold = config.width if stream else float("inf")
+
     def redent(self, tokened_lines):
         """
         Redent the given iterable of tokenized lines.
@@ -34,8 +48,13 @@ class Condenter(object):
 
     def reassemble(self):
         unprocessed = []
+        stack = self.stack
+
+        if self.streaming is not None:
+            unprocessed.append(self.streaming.flush())
+            stack = stack[1:]
 
-        for delimiter, items in reversed(self.stack):
+        for delimiter, items in stack:
             unprocessed.append(
                 "".join([
                     delimiter.before,
@@ -44,7 +63,7 @@ class Condenter(object):
                     ])
             )
 
-        return "".join(reversed(unprocessed))
+        return "".join(unprocessed)
 
     def visit(self, token):
         """
@@ -63,6 +82,8 @@ class Condenter(object):
 
         """
 
+        if not self.stack and self.stream:
+            self.buffered, self.threshold = 0, self.config.width
         self.stack.append((token, []))
 
     def visit_NonDelimiter(self, token):
@@ -73,22 +94,52 @@ class Condenter(object):
         until the right delimiter is reached. Otherwise it's a non-container
         line, and is returned unchanged immediately.
 
+        Once an outermost container is known not to fit on a line, its items
+        are streamed as they are seen rather than being buffered.
+
         """
 
         if not self.stack:
             return token.content
 
-        item_tokens = self.stack[-1][1]
+        if len(self.stack) == 1:
+            if self.streaming is not None:
+                return self.streaming.feed([token.content]) or None
+
+            self.buffered += len(token.content)
+
+        left_token, item_tokens = self.stack[-1]
         item_tokens.append(token)
 
+        if len(self.stack) == 1 and self.buffered > self.threshold:
+            self.streaming = self.builder.stream(
+                left_token.before,
+                left_token.delimiter,
+                [item.content for item in item_tokens],
+            )
+            if self.streaming is None:
+                self.threshold *= 2
+            else:
+                del item_tokens[:]
+                return self.streaming.open()
+
     def visit_RightDelimiter(self, right_token):
         """
         A right delimiter was encountered.
 
-        It's time to redent and return the buffered lines.
+        It's time to redent and return the buffered lines. A right delimiter
+        outside of any container is returned unchanged.
 
         """
 
+        if not self.stack:
+            return right_token.delimiter
+
+        if len(self.stack) == 1 and self.streaming is not None:
+            self.stack.pop()
+            streaming, self.streaming = self.streaming, None
+            return streaming.close(right_token.delimiter)
+
         left_token, item_tokens = self.stack.pop()
         redented = self.builder.build(
             left_token.before,
@@ -106,6 +157,7 @@ class LiteralBuilder(object):
 
         self.builders = builders
         self.config = config
+        self.stats = Counter()
 
     def build(self, before, left_delimiter, items, right_delimiter):
         builder = getattr(self, "build_" + self.builders[left_delimiter])
@@ -119,47 +171,390 @@ class LiteralBuilder(object):
 
     def build_dict(self, before, left_delimiter, items, right_delimiter):
         separator = " : " if self.config.symmetric_colons else ": "
+        if is_condented(
+            before,
+            left_delimiter,
+            items,
+            right_delimiter,
+            trailing_comma=self.config.trailing_comma,
+            separator=separator,
+            width=self.config.width,
+        ):
+            return self.unchanged(
+                before, left_delimiter, items, right_delimiter,
+            )
+
+        self.stats["rebuilt"] += 1
         return dict_literal(
             before,
             left_delimiter,
             _clean_dict_items(items, separator),
             right_delimiter,
             trailing_comma=self.config.trailing_comma,
+            width=self.config.width,
         )
 
     def build_sequence(self, before, left_delimiter, items, right_delimiter):
+        if is_condented(
+            before,
+            left_delimiter,
+            items,
+            right_delimiter,
+            trailing_comma=self.config.trailing_comma,
+            width=self.config.width,
+        ):
+            return self.unchanged(
+                before, left_delimiter, items, right_delimiter,
+            )
+
+        self.stats["rebuilt"] += 1
         return container_literal(
             before,
             left_delimiter,
             _clean_sequence_items(items),
             right_delimiter,
-            self.config.trailing_comma,
+            trailing_comma=self.config.trailing_comma,
+            width=self.config.width,
+        )
+
+    def stream(self, before, left_delimiter, items):
+        """
+        Start streaming a container if it is known to need one item per line.
+
+        Returns ``None`` if it is not yet known.
+
+        """
+
+        kind, separator = self.builders[left_delimiter], None
+        if kind == "brace" and is_dict(before, left_delimiter, items, None):
+            separator = " : " if self.config.symmetric_colons else ": "
+            clean = lambda items : _clean_dict_items(items, separator)
+        elif kind in ("brace", "sequence"):
+            clean = _clean_sequence_items
+        else:
+            return None
+
+        literal = StreamedLiteral(
+            before,
+            left_delimiter,
+            items,
+            clean,
+            separator=separator,
+            trailing_comma=self.config.trailing_comma,
+            stats=self.stats,
         )
+        itms = [item for _, each in literal.seen for item in each]
+        width = len(literal.indent) + 4 + _joined_width(itms)
+        if not itms or width <= self.config.width:
+            return None
+        return literal
+
+    def unchanged(self, before, left_delimiter, items, right_delimiter):
+        """
+        Return a container which is already condented as it was.
+
+        """
+
+        self.stats["unchanged"] += 1
+        return "".join([before, left_delimiter] + items + [right_delimiter])
+
+
+class StreamedLiteral(object):
+    """
+    A container which is emitted one item per line as its items are seen.
+
+    Only the last item seen is held back, since whether it needs a trailing
+    comma isn't known until the next item or the right delimiter is seen.
+    Whether it was followed by a comma and newline is remembered in case the
+    container is never closed.
+
+    The input not yet matched by the output is held too, for as long as the
+    two agree, so that a closed container can be counted as unchanged or
+    rebuilt like any other.
+
+    """
+
+    def __init__(
+        self,
+        before,
+        left_delimiter,
+        lines,
+        clean,
+        separator=None,
+        trailing_comma=True,
+        stats=None,
+    ):
+        if stats is None:
+            stats = Counter()
+
+        self.before = _clean_before(before)
+        self.left_delimiter = left_delimiter
+        self.clean = clean
+        self.separator = separator
+        self.trailing_comma = trailing_comma
+        self.stats = stats
+
+        self.indent = _indent_for(self.before)
+        self.item_indent = self.indent + "    "
+        self.last = None
+        self.tail = ""
+        self.unmatched = before + left_delimiter + "".join(lines)
+        self.changed = False
+
+        self.seen = [(line, self.items(line)) for line in lines]
+
+    def open(self):
+        """
+        Return the first line of the container and the items seen so far.
+
+        """
+
+        seen, self.seen = self.seen, None
+        opening = self.match(self.before + self.left_delimiter + "\n")
+        return opening + self._feed(seen)
+
+    def feed(self, lines):
+        """
+        Return the item lines which became available after the given lines.
+
+        """
+
+        if not self.changed:
+            self.unmatched += "".join(lines)
+        return self._feed((line, self.items(line)) for line in lines)
+
+    def _feed(self, seen):
+        emitted = []
+        for line, items in seen:
+            if items:
+                emitted.append(self.match(self.emit(items)))
+                self.tail = ""
+            if line.rstrip().endswith(",") and "," not in self.tail:
+                self.tail += ","
+            if line.endswith("\n") and "\n" not in self.tail:
+                self.tail += "\n"
+        return "".join(emitted)
+
+    def items(self, line):
+        """
+        Clean the items on a line, without regexes if it is already condented.
+
+        """
+
+        if line.startswith(self.item_indent) and line.endswith(",\n"):
+            items = _condented_items(
+                line[len(self.item_indent):-2], self.separator,
+            )
+            if items:
+                return items
+        return list(self.clean([line]))
+
+    def emit(self, items):
+        lines = []
+        for item in items:
+            if self.last is not None:
+                lines.append(self.indent + "    " + self.last + ",\n")
+            self.last = item
+        return "".join(lines)
+
+    def close(self, right_delimiter):
+        """
+        Return the last item and the closing line of the container.
+
+        """
+
+        trailing = "," if self.trailing_comma else ""
+        closing = "{indent}    {last}{trailing}\n{indent}{right}".format(
+            indent=self.indent,
+            last=self.last,
+            trailing=trailing,
+            right=right_delimiter,
+        )
+
+        if not self.changed:
+            self.unmatched += right_delimiter
+        self.match(closing)
+        if self.changed or self.unmatched:
+            self.stats["rebuilt"] += 1
+        else:
+            self.stats["unchanged"] += 1
+        return closing
+
+    def match(self, output):
+        """
+        Check output against the input, returning it.
+
+        """
+
+        if not self.changed:
+            if self.unmatched.startswith(output):
+                self.unmatched = self.unmatched[len(output):]
+            else:
+                self.changed, self.unmatched = True, ""
+        return output
+
+    def flush(self):
+        """
+        Return the held back item of a container which was never closed.
+
+        """
+
+        if self.last is None:
+            return ""
+        return self.indent + "    " + self.last + self.tail
 
 
 def dict_literal(
-    before, left_delimiter, items, right_delimiter, trailing_comma=True,
+    before,
+    left_delimiter,
+    items,
+    right_delimiter,
+    trailing_comma=True,
+    width=79,
 ):
     return container_literal(
-        before, left_delimiter, items, right_delimiter, trailing_comma,
+        before, left_delimiter, items, right_delimiter, trailing_comma, width,
     )
 
 
 def container_literal(
-    before, left_delimiter, items, right_delimiter, trailing_comma=True,
+    before,
+    left_delimiter,
+    items,
+    right_delimiter,
+    trailing_comma=True,
+    width=79,
 ):
     before = _clean_before(before)
     items = list(items)
+    indent = _indent_for(before)
 
-    c = _single_line_container(before, left_delimiter, items, right_delimiter)
-    if len(c) <= 79:
-        return c
+    comma = "," if is_tuple(before, left_delimiter) and len(items) == 1 else ""
+    joined = _joined_width(items) + len(comma)
 
-    return _multi_line_container(
-        before, left_delimiter, items, right_delimiter, trailing_comma,
+    if items and len(indent) + 4 + joined > width:
+        trailing = "," if trailing_comma else ""
+        itms = ",\n".join(indent + "    " + item for item in items) + trailing
+    elif (
+        not items or
+        len(before + left_delimiter + right_delimiter) + joined <= width
+    ):
+        return "".join(
+            [before, left_delimiter, ", ".join(items), comma, right_delimiter],
+        )
+    else:
+        itms = indent + "    " + ", ".join(items) + (comma or ",")
+
+    return "{before}{left}\n{items}\n{indent}{right}".format(
+        before=before,
+        left=left_delimiter,
+        items=itms,
+        indent=indent,
+        right=right_delimiter,
     )
 
 
+def is_condented(
+    before,
+    left_delimiter,
+    items,
+    right_delimiter,
+    trailing_comma=True,
+    separator=None,
+    width=79,
+):
+    """
+    Check whether a container is already laid out as it would be rebuilt.
+
+    Only separators, indentation and width are checked, so some containers
+    which are already condented will not be recognized and will simply be
+    rebuilt.
+
+    """
+
+    if before != _clean_before(before):
+        return False
+
+    tuple = is_tuple(before, left_delimiter)
+    indent = _indent_for(before)
+    item_indent = indent + "    "
+    outside = len(before) + len(left_delimiter) + len(right_delimiter)
+
+    if len(items) <= 1 and "\n" not in "".join(items):
+        line = items[0] if items else ""
+        trailing = tuple and line.endswith(",")
+        itms = _condented_items(line[:-1] if trailing else line, separator)
+        if itms is None or trailing != (tuple and len(itms) == 1):
+            return False
+        return (
+            len(item_indent) + len(line) <= width and
+            outside + len(line) <= width
+        )
+
+    if items[0] != "\n":
+        return False
+
+    lines = items[1:]
+    if indent:
+        if lines[-1:] != [indent]:
+            return False
+        lines = lines[:-1]
+
+    itms, per_line, comma = [], [], True
+    for i, line in enumerate(lines):
+        if (
+            not line.startswith(item_indent) or
+            not line.endswith("\n") or "\n" in line[:-1]
+        ):
+            return False
+
+        line = line[len(item_indent):]
+        if line.endswith(",\n"):
+            line = line[:-2]
+        elif not trailing_comma and i == len(lines) - 1:
+            comma, line = False, line[:-1]
+        else:
+            return False
+
+        condented = _condented_items(line, separator)
+        if not condented:
+            return False
+        itms.extend(condented)
+        per_line.append(len(condented))
+
+    if not itms or tuple and len(itms) == 1:
+        return False
+
+    joined = _joined_width(itms)
+    if len(item_indent) + joined <= width:
+        return outside + joined > width and per_line == [len(itms)] and comma
+    return per_line == [1] * len(itms) and comma == trailing_comma
+
+
+def _condented_items(line, separator=None):
+    """
+    Split a line into items if it is exactly those items, cleanly separated.
+
+    """
+
+    if not line:
+        return []
+
+    items = line.split(", ")
+    for item in items:
+        if not item or "," in item or item != item.strip():
+            return None
+
+        if separator is not None:
+            key, sep, value = item.partition(separator)
+            if (
+                not sep or ":" in key or ":" in value or
+                key != key.rstrip() or value != value.lstrip()
+            ):
+                return None
+    return items
+
+
 def _clean_before(before):
     return re.sub("\s*=\s*$", " = ", before)
 
@@ -194,40 +589,13 @@ def _sequence_item(item):
     return item.strip()
 
 
-def _single_line_container(before, left_delimiter, itms, right_delimiter):
-    itms = items(before, left_delimiter, itms)
-    return "".join([before, left_delimiter, itms, right_delimiter])
-
-
-def _multi_line_container(
-    before, left_delimiter, itms, right_delimiter, trailing_comma,
-):
-    indent = _indent_for(before)
-    itms = items(before, left_delimiter, itms, trailing_comma)
-
-    if len(itms) < 79:
-        itms = indent + "    " + itms + ","
-
-    return "{before}{left}\n{items}\n{indent}{right}".format(
-        before=before,
-        left=left_delimiter,
-        items=itms,
-        indent=indent,
-        right=right_delimiter,
-    )
-
-
-def items(before, left_delimiter, items, trailing_comma=True):
-    indent = "    " + _indent_for(before)
-    joined = ", ".join(items)
+def _joined_width(items):
+    """
+    The width of the given items once they are joined onto a single line.
 
-    if is_tuple(before, left_delimiter) and len(items) == 1:
-        joined += ","
+    """
 
-    if len(indent + joined) > 79:
-        trailing = "," if trailing_comma else ""
-        return ",\n".join(indent + item for item in items) + trailing
-    return joined
+    return sum(len(item) for item in items) + 2 * max(len(items) - 1, 0)
 
 
 class Token(object):
@@ -280,44 +648,160 @@ def tokenize(parsed, left_delimiters, right_delimiters):
 
 
 class ParsesDelimiters(object):
-    def __init__(self, delimiters):
-        self.buffer = []
-        self.delimiters = delimiters
-        self.in_string = False
+    def __init__(self, delimiters, language=None):
+        if language is None:
+            language = PYTHON
 
-    def _parse(self, line):
-        for c in line:
-            if self.in_string:
-                yield self.see_in_string(c)
-            else:
-                for result in self.see(c):
-                    yield result
-        yield self.empty_buffer()
+        self.delimiters = delimiters
+        self.language = language
+        self.states = language.table(delimiters)
+        self.state = 0
 
     def parse(self, line):
-        return (result for result in self._parse(line) if result is not None)
+        """
+        Split a line into delimiters and the text between them.
 
-    def see(self, c):
-        if c in self.delimiters:
-            yield self.empty_buffer()
-            yield c
-        else:
-            self.buffer.append(c)
+        Delimiters inside of comments or strings are not split on. Blocks (like
+        triple quoted strings) may span lines, so which one the parser is in
+        is remembered between lines.
 
-            if c in """"'""":
-                self.in_string = True
+        """
 
-    def see_in_string(self, c):
-        if c in """"'""":
-            self.in_string = False
-        self.buffer.append(c)
+        code = self.states[0]
+        start = position = 0
+
+        while position < len(line):
+            if self.state:
+                match = self.states[self.state].match(line, position)
+                if match is None:
+                    break
+                self.state, position = 0, match.end()
+                continue
+
+            match = code.search(line, position)
+            if match is None:
+                break
+
+            kind, position = match.lastgroup, match.end()
+            if kind == "delimiter":
+                if match.start() > start:
+                    yield line[start:match.start()]
+                yield match.group()
+                start = position
+            elif kind != "skip":
+                self.state = int(kind[len("block"):])
+
+        if start < len(line):
+            yield line[start:]
+
+
+class Language(object):
+    """
+    The lexical rules of a language which matter for finding delimiters.
+
+    Line comments and strings which end on the line they start on are skipped
+    in bulk, as are blocks (like triple quoted strings or block comments) that
+    may span many lines. The rules are compiled into a table of states, one
+    for code and one for each kind of block, the first time a table is needed
+    for a set of delimiters.
+
+    """
+
+    def __init__(
+        self, name, extensions=(), comments=(), strings=(), blocks=(),
+    ):
+        self.name = name
+        self.extensions = extensions
+        self.comments = comments
+        self.strings = strings
+        self.blocks = blocks
+        self.tables = {}
 
-    def empty_buffer(self):
-        if self.buffer:
-            try:
-                return "".join(self.buffer)
-            finally:
-                self.buffer = []
+    def __repr__(self):
+        return "<Language {0}>".format(self.name)
+
+    def table(self, delimiters):
+        """
+        The table of states for the given delimiters.
+
+        The first state matches the next delimiter, comment, string or start
+        of a block in code, and each other state matches through the end of
+        its block.
+
+        """
+
+        delimiters = "".join(sorted(delimiters))
+        table = self.tables.get(delimiters)
+        if table is None:
+            table = self.tables[delimiters] = self._compile(delimiters)
+        return table
+
+    def _compile(self, delimiters):
+        skip = [re.escape(comment) + r"[^\n]*" for comment in self.comments]
+        skip.extend(
+            r"{0}(?:[^{0}\\\n]|\\.)*{0}?".format(re.escape(quote))
+            for quote in self.strings
+        )
+
+        code = ["(?P<delimiter>[{0}])".format(re.escape(delimiters))]
+        code.extend(
+            "(?P<block{0}>{1})".format(i, start)
+            for i, (start, _, _) in enumerate(self.blocks, 1)
+        )
+        if skip:
+            code.append("(?P<skip>{0})".format("|".join(skip)))
+
+        states = [re.compile("|".join(code), re.M)]
+        for _, end, escapes in self.blocks:
+            body = r"(?:[^\\]|\\.)*?" if escapes else r".*?"
+            states.append(re.compile(body + end, re.M | re.S))
+        return states
+
+
+PYTHON = Language(
+    "python",
+    extensions=(".py",),
+    comments=("#",),
+    strings=("'", '"'),
+    blocks=(('"""', '"""', True), ("'''", "'''", True)),
+)
+JAVASCRIPT = Language(
+    "javascript",
+    extensions=(".js", ".jsx", ".mjs", ".cjs"),
+    comments=("//",),
+    strings=("'", '"'),
+    blocks=((r"/\*", r"\*/", False), ("`", "`", True)),
+)
+RUBY = Language(
+    "ruby",
+    extensions=(".rb",),
+    comments=("#",),
+    strings=("'", '"'),
+    blocks=((r"^=begin\b", r"^=end\b", False),),
+)
+JSON = Language("json", extensions=(".json",), strings=('"',))
+LANGUAGES = dict(
+    (language.name, language)
+    for language in [PYTHON, JAVASCRIPT, RUBY, JSON]
+)
+
+
+def language_for(path, name=None):
+    """
+    Find the language with the given name, or else the one for the given path.
+
+    Paths are matched by extension, defaulting to Python.
+
+    """
+
+    if name is not None:
+        return LANGUAGES[name]
+
+    _, extension = os.path.splitext(path)
+    for language in LANGUAGES.values():
+        if extension in language.extensions:
+            return language
+    return PYTHON
 
 
 def is_tuple(before, left_delimiter):
@@ -327,3 +811,773 @@ def is_tuple(before, left_delimiter):
 
 def is_dict(before, left_delimiter, context, right_delimiter):
     return any(":" in line for line in context)
+
+
+def redent(lines, config, builder=None, language=None, stream=True):
+    """
+    Redent the given iterable of lines using the given config.
+
+    Returns a generator which will yield redented lines. Containers which
+    don't fit are streamed unless ``stream`` is false, which should be the
+    case for partial input, where containers may never be closed.
+
+    """
+
+    if builder is None:
+        builder = LiteralBuilder(config=config)
+
+    tokenize_line = _tokenizer(language)
+    tokens = (tokenize_line(line) for line in lines)
+    condenter = Condenter(builder, config=config, stream=stream)
+    return condenter.redent(tokens)
+
+
+def _tokenizer(language=None):
+    left, right = list(DELIMITERS), list(DELIMITERS.values())
+    parser = ParsesDelimiters(left + right, language=language)
+    return lambda line : tokenize(parser.parse(line), left, right)
+
+
+def unified_diff(
+    lines,
+    config,
+    fromfile="",
+    tofile="",
+    context=3,
+    builder=None,
+    language=None,
+):
+    """
+    Yield a unified diff between the given lines and their redented form.
+
+    Hunks are produced as redented lines stream out, by aligning the input
+    with the output after each line which leaves no container open. Nothing
+    is yielded if redenting leaves the lines unchanged.
+
+    """
+
+    chunks = _aligned(lines, config, builder, language)
+    for i, hunk in enumerate(_hunks(chunks, context)):
+        if not i:
+            yield "--- {0}\n+++ {1}\n".format(fromfile, tofile)
+        for line in hunk:
+            yield line
+
+
+def diff_file(path, config):
+    """
+    Return a unified diff for redenting the given file, and its stats.
+
+    """
+
+    builder = LiteralBuilder(config=config)
+    language = language_for(path, config.language)
+    with open(path) as file:
+        diff = unified_diff(
+            file,
+            config,
+            fromfile=path,
+            tofile=path,
+            builder=builder,
+            language=language,
+        )
+        return "".join(diff), builder.stats
+
+
+OUTPUT_LINE = re.compile(r"[^\n]*\n|[^\n]+")
+
+
+def _aligned(lines, config, builder=None, language=None):
+    """
+    Redent lines, yielding pairs of input lines and their redented text.
+
+    """
+
+    if builder is None:
+        builder = LiteralBuilder(config=config)
+
+    tokenize_line = _tokenizer(language)
+    condenter = Condenter(builder, config=config, stream=False)
+    old, new = [], []
+
+    for line in lines:
+        old.append(line)
+        for token in tokenize_line(line):
+            output = condenter.visit(token)
+            if output is not None:
+                new.append(output)
+
+        if not condenter.stack:
+            yield old, "".join(new)
+            old, new = [], []
+
+    if condenter.stack:
+        new.append(condenter.reassemble())
+    if old:
+        yield old, "".join(new)
+
+
+def _hunks(chunks, context):
+    """
+    Group aligned chunks into hunks with the given number of context lines.
+
+    """
+
+    hunk, leading = None, deque(maxlen=context)
+    old_number = new_number = 0
+
+    for old, new in chunks:
+        if "".join(old) == new:
+            for line in old:
+                old_number += 1
+                new_number += 1
+
+                if hunk is None:
+                    leading.append(line)
+                    continue
+
+                lines = hunk[2]
+                lines.append(" " + line)
+                trailing += 1
+                if trailing > 2 * context:
+                    extra = trailing - context
+                    leading.extend(each[1:] for each in lines[-extra:])
+                    del lines[-extra:]
+                    yield _hunk(*hunk)
+                    hunk = None
+            continue
+
+        new = OUTPUT_LINE.findall(new)
+        if hunk is None:
+            hunk = (
+                old_number - len(leading),
+                new_number - len(leading),
+                [" " + line for line in leading],
+            )
+            leading.clear()
+
+        hunk[2].extend("-" + line for line in old)
+        hunk[2].extend("+" + line for line in new)
+        old_number += len(old)
+        new_number += len(new)
+        trailing = 0
+
+    if hunk is not None:
+        if trailing > context:
+            del hunk[2][context - trailing:]
+        yield _hunk(*hunk)
+
+
+def _hunk(old_start, new_start, lines):
+    old = sum(1 for line in lines if line[0] in " -")
+    new = sum(1 for line in lines if line[0] in " +")
+    yield "@@ -{0} +{1} @@\n".format(
+        _hunk_range(old_start, old), _hunk_range(new_start, new),
+    )
+    for line in lines:
+        yield line
+        if not line.endswith("\n"):
+            yield "\n\\ No newline at end of file\n"
+
+
+def _hunk_range(start, length):
+    if length == 1:
+        return str(start + 1)
+    if not length:
+        return "{0},0".format(start)
+    return "{0},{1}".format(start + 1, length)
+
+
+LINE = re.compile(r"[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+")
+
+
+class Document(object):
+    """
+    An open document, kept in memory as a list of lines.
+
+    """
+
+    def __init__(self, text, version=None):
+        self.lines = LINE.findall(text)
+        self.version = version
+        self.revision = 0
+
+    @property
+    def text(self):
+        return "".join(self.lines)
+
+    def change(self, text, range=None, version=None):
+        """
+        Apply a change to the document.
+
+        Without a range, the whole document is replaced, otherwise only the
+        lines that the range touches are.
+
+        """
+
+        if range is None:
+            self.lines = LINE.findall(text)
+        else:
+            start, end = range["start"], range["end"]
+            first, last = start["line"], end["line"]
+            head = self._line(first)[:start["character"]]
+            tail = self._line(last)[end["character"]:]
+            self.lines[first:last + 1] = LINE.findall(head + text + tail)
+
+        if version is not None:
+            self.version = version
+        self.revision += 1
+
+    def _line(self, number):
+        if number < len(self.lines):
+            return self.lines[number]
+        return ""
+
+
+def read_message(input):
+    """
+    Read a JSON-RPC message framed with a ``Content-Length`` header.
+
+    Returns ``None`` once the input is exhausted.
+
+    """
+
+    length = None
+
+    while True:
+        header = input.readline()
+        if not header:
+            return None
+        header = header.strip()
+        if not header:
+            break
+        name, _, value = header.partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+
+    if length is None:
+        return None
+    return json.loads(input.read(length))
+
+
+def write_message(output, message):
+    """
+    Write a JSON-RPC message framed with a ``Content-Length`` header.
+
+    """
+
+    body = json.dumps(message)
+    output.write("Content-Length: {0}\r\n\r\n{1}".format(len(body), body))
+    output.flush()
+
+
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+REQUEST_CANCELLED = -32800
+CONTENT_MODIFIED = -32801
+
+
+class Server(object):
+    """
+    A stdio server speaking enough of the language server protocol to keep
+    documents in sync and to redent ranges of them.
+
+    Documents are held in memory so that clients need only send deltas.
+    Formatting happens on a worker thread so that document changes keep being
+    read while large documents are being redented, and requests that are made
+    stale by a newer change are cancelled, even once they are being worked on,
+    which is checked every ``check_every`` chunks of output.
+
+    """
+
+    def __init__(self, config, input, output, builder=None, check_every=100):
+        if builder is None:
+            builder = LiteralBuilder(config=config)
+
+        self.builder = builder
+        self.config = config
+        self.input = input
+        self.output = output
+        self.check_every = check_every
+
+        self.documents = {}
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.running = False
+
+    def serve(self):
+        """
+        Serve requests until the client exits or the input is exhausted.
+
+        """
+
+        self.running = True
+        worker = threading.Thread(target=self.work)
+        worker.daemon = True
+        worker.start()
+
+        try:
+            while self.running:
+                message = read_message(self.input)
+                if message is None:
+                    break
+                self.dispatch(message)
+        finally:
+            with self.condition:
+                self.running = False
+                self.condition.notify()
+            worker.join()
+
+    def dispatch(self, message):
+        method = message.get("method")
+        if method is None:
+            return
+
+        id, params = message.get("id"), message.get("params", {})
+        name = "lsp_" + method.lstrip("$/").replace("/", "_")
+        handler = getattr(self, name, None)
+        if handler is not None:
+            handler(id, params)
+        elif id is not None:
+            self.error(id, METHOD_NOT_FOUND, "Unknown method: " + method)
+
+    def respond(self, id, result):
+        self.send({"jsonrpc" : "2.0", "id" : id, "result" : result})
+
+    def error(self, id, code, message):
+        error = {"code" : code, "message" : message}
+        self.send({"jsonrpc" : "2.0", "id" : id, "error" : error})
+
+    def send(self, message):
+        with self.write_lock:
+            write_message(self.output, message)
+
+    def work(self):
+        """
+        Redent ranges of documents as formatting requests come in.
+
+        """
+
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                id, uri, revision, start, lines = self.pending.popleft()
+
+            try:
+                redented = self.redent(uri, revision, lines)
+            except Exception as exception:
+                message = "Redenting failed: {0}".format(exception)
+                self.error(id, INTERNAL_ERROR, message)
+                continue
+
+            if redented is None or self.is_stale(uri, revision):
+                self.error(id, CONTENT_MODIFIED, "Document changed.")
+                continue
+
+            if redented == "".join(lines):
+                self.respond(id, [])
+            else:
+                range = {
+                    "start" : {"line" : start, "character" : 0},
+                    "end" : {"line" : start + len(lines), "character" : 0},
+                }
+                self.respond(id, [{"range" : range, "newText" : redented}])
+
+    def redent(self, uri, revision, lines):
+        """
+        Redent lines of a document, or return ``None`` if it changes first.
+
+        """
+
+        language = language_for(uri, self.config.language)
+        redented = redent(
+            lines, self.config, self.builder, language=language, stream=False,
+        )
+
+        chunks = []
+        for chunk in redented:
+            chunks.append(chunk)
+            if (
+                not len(chunks) % self.check_every and
+                self.is_stale(uri, revision)
+            ):
+                return None
+        return "".join(chunks)
+
+    def is_stale(self, uri, revision):
+        with self.condition:
+            document = self.documents.get(uri)
+            return document is None or document.revision != revision
+
+    def cancel(self, predicate, code, message):
+        with self.condition:
+            for job in list(self.pending):
+                if predicate(job):
+                    self.pending.remove(job)
+                    self.error(job[0], code, message)
+
+    def lsp_initialize(self, id, params):
+        capabilities = {
+            "textDocumentSync" : {"openClose" : True, "change" : 2},
+            "documentRangeFormattingProvider" : True,
+        }
+        self.respond(id, {"capabilities" : capabilities})
+
+    def lsp_initialized(self, id, params):
+        pass
+
+    def lsp_shutdown(self, id, params):
+        self.respond(id, None)
+
+    def lsp_exit(self, id, params):
+        self.running = False
+
+    def lsp_cancelRequest(self, id, params):
+        cancelled = params["id"]
+        self.cancel(
+            lambda job : job[0] == cancelled,
+            REQUEST_CANCELLED,
+            "Request cancelled.",
+        )
+
+    def lsp_textDocument_didOpen(self, id, params):
+        document = params["textDocument"]
+        with self.condition:
+            self.documents[document["uri"]] = Document(
+                document["text"], version=document.get("version"),
+            )
+
+    def lsp_textDocument_didChange(self, id, params):
+        uri = params["textDocument"]["uri"]
+        self.cancel(
+            lambda job : job[1] == uri, CONTENT_MODIFIED, "Document changed.",
+        )
+
+        with self.condition:
+            document = self.documents.get(uri)
+            if document is None:
+                return
+            for change in params["contentChanges"]:
+                document.change(change["text"], range=change.get("range"))
+            document.version = params["textDocument"].get("version")
+
+    def lsp_textDocument_didClose(self, id, params):
+        uri = params["textDocument"]["uri"]
+        self.cancel(
+            lambda job : job[1] == uri, CONTENT_MODIFIED, "Document closed.",
+        )
+
+        with self.condition:
+            self.documents.pop(uri, None)
+
+    def lsp_textDocument_rangeFormatting(self, id, params):
+        uri = params["textDocument"]["uri"]
+        start, end = params["range"]["start"], params["range"]["end"]
+
+        last = end["line"]
+        if end["character"] or last == start["line"]:
+            last += 1
+
+        with self.condition:
+            document = self.documents.get(uri)
+            if document is None:
+                self.error(id, INVALID_PARAMS, "Document is not open: " + uri)
+                return
+            lines = document.lines[start["line"]:last]
+            job = id, uri, document.revision, start["line"], lines
+            self.pending.append(job)
+            self.condition.notify()
+
+
+EXTENSIONS = PYTHON.extensions
+
+
+def walk(paths, extensions=EXTENSIONS):
+    """
+    Find the directories and files to watch within the given paths.
+
+    Files given explicitly are always included, whereas those found within
+    directories are included only if they have one of the given extensions.
+
+    """
+
+    directories, files = set(), set()
+    for path in paths:
+        if not os.path.isdir(path):
+            files.add(os.path.abspath(path))
+            continue
+
+        for root, _, names in os.walk(path):
+            directories.add(os.path.abspath(root))
+            files.update(
+                os.path.abspath(os.path.join(root, name))
+                for name in names if name.endswith(extensions)
+            )
+    return directories, files
+
+
+IN_CLOEXEC = 0o2000000
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class Inotify(object):
+    """
+    Watch for changes using inotify.
+
+    Raises :exc:`OSError` if inotify is not available.
+
+    """
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, paths, delay, extensions=EXTENSIONS):
+        libc = ctypes.util.find_library("c")
+        if libc is None:
+            raise OSError("inotify is not available")
+        self.libc = ctypes.CDLL(libc, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.delay = delay
+        self.extensions = extensions
+        self.directories, self.files = walk(paths, extensions)
+        self.watches, self.watched = {}, set()
+
+        for directory in self.directories:
+            self.add_watch(directory)
+        for path in self.files:
+            self.add_watch(os.path.dirname(path))
+
+    def add_watch(self, directory):
+        if directory in self.watched:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, directory, self.MASK)
+        if wd >= 0:
+            self.watches[wd] = directory
+            self.watched.add(directory)
+
+    def changes(self):
+        """
+        Yield sets of paths which changed, once each burst of changes settles.
+
+        """
+
+        while True:
+            select.select([self.fd], [], [])
+            changed = set()
+            while select.select([self.fd], [], [], self.delay)[0]:
+                changed.update(self.read())
+            if changed:
+                yield changed
+
+    def read(self):
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                for path in self.files:
+                    yield path
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+
+            if mask & IN_ISDIR:
+                if directory in self.directories:
+                    directories, files = walk([path], self.extensions)
+                    for new in directories:
+                        self.directories.add(new)
+                        self.add_watch(new)
+                    self.files.update(files)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                if path in self.files or (
+                    directory in self.directories and
+                    name.endswith(self.extensions)
+                ):
+                    self.files.add(path)
+                    yield path
+
+
+class Poller(object):
+    """
+    Watch for changes by periodically checking modification times.
+
+    Only directories whose own modification time changes are listed again, so
+    the tree is not rescanned on every poll.
+
+    """
+
+    def __init__(self, paths, delay, interval=0.5, extensions=EXTENSIONS):
+        self.delay = delay
+        self.interval = interval
+        self.extensions = extensions
+
+        directories, files = walk(paths, extensions)
+        self.directories = dict((each, _stat(each)) for each in directories)
+        self.files = dict((each, _stat(each)) for each in files)
+
+    def changes(self):
+        """
+        Yield sets of paths which changed, once each burst of changes settles.
+
+        """
+
+        while True:
+            time.sleep(self.interval)
+            changed = self.poll()
+            if not changed:
+                continue
+
+            while True:
+                time.sleep(self.delay)
+                more = self.poll()
+                if not more:
+                    break
+                changed.update(more)
+            yield changed
+
+    def poll(self):
+        changed = set()
+
+        for directory, seen in list(self.directories.items()):
+            stat = _stat(directory)
+            if stat == seen:
+                continue
+            self.directories[directory] = stat
+            if stat is None:
+                continue
+
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if path in self.files or path in self.directories:
+                    continue
+                if os.path.isdir(path):
+                    directories, files = walk([path], self.extensions)
+                    for each in directories:
+                        self.directories[each] = _stat(each)
+                    for each in files:
+                        self.files[each] = None
+                elif name.endswith(self.extensions):
+                    self.files[path] = None
+
+        for path, seen in self.files.items():
+            stat = _stat(path)
+            if stat != seen:
+                self.files[path] = stat
+                if stat is not None:
+                    changed.add(path)
+        return changed
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+class Watcher(object):
+    """
+    Redent files in place whenever they change.
+
+    The last contents seen for each file are kept, so that files which were
+    touched without changing (including by this watcher's own writes) are not
+    redented again. Files which fail to redent (say, because they were saved
+    mid-edit) are reported and left alone until they change again.
+
+    """
+
+    def __init__(self, paths, config, builder=None, delay=0.1, errors=None):
+        if builder is None:
+            builder = LiteralBuilder(config=config)
+        if errors is None:
+            errors = sys.stderr
+
+        self.builder = builder
+        self.config = config
+        self.errors = errors
+        self.known = {}
+
+        extensions = EXTENSIONS
+        if config.language is not None:
+            extensions = LANGUAGES[config.language].extensions
+
+        try:
+            self.changes = Inotify(paths, delay=delay, extensions=extensions)
+        except OSError:
+            self.changes = Poller(paths, delay=delay, extensions=extensions)
+
+    def watch(self):
+        """
+        Watch for changes forever.
+
+        """
+
+        for changed in self.changes.changes():
+            for path in sorted(changed):
+                try:
+                    self.redent(path)
+                except Exception as exception:
+                    self.known.pop(path, None)
+                    self.errors.write(
+                        "Could not redent {0}: {1}\n".format(path, exception),
+                    )
+
+    def redent(self, path):
+        """
+        Redent the given file in place if it changed since it was last seen.
+
+        Returns whether the file was rewritten.
+
+        """
+
+        try:
+            with open(path) as file:
+                content = file.read()
+        except IOError:
+            self.known.pop(path, None)
+            return False
+
+        if content == self.known.get(path):
+            return False
+
+        lines = content.splitlines(True)
+        language = language_for(path, self.config.language)
+        redented = "".join(
+            redent(
+                lines,
+                self.config,
+                self.builder,
+                language=language,
+                stream=False,
+            ),
+        )
+        self.known[path] = redented
+
+        if redented == content:
+            return False
+        with open(path, "w") as file:
+            file.write(redented)
+        return True
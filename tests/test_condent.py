@@ -1,6 +1,11 @@
 from functools import wraps
+from StringIO import StringIO
 from textwrap import dedent
 from unittest import TestCase
+import os
+import shutil
+import tempfile
+
 import mock
 
 
@@ -162,11 +167,78 @@ class TestParsesDelimiters(TestCase):
             ["foo = ", "[", '"""[1]""", \'\'\'[4]\'\'\'', "]"],
         )
 
+    def test_it_does_not_split_delimiters_in_comments(self):
+        source = "foo = [1, 2]  # [3\n"
+        self.assertEqual(
+            list(self.parser.parse(source)),
+            ["foo = ", "[", "1, 2", "]", "  # [3\n"],
+        )
+
+    def test_it_does_not_end_strings_at_escaped_quotes(self):
+        source = r'foo = ["\"]", 1]'
+        self.assertEqual(
+            list(self.parser.parse(source)),
+            ["foo = ", "[", r'"\"]", 1', "]"],
+        )
+
+    def test_it_does_not_end_strings_at_other_quotes(self):
+        source = "foo = [\"it's]\", 1]"
+        self.assertEqual(
+            list(self.parser.parse(source)),
+            ["foo = ", "[", "\"it's]\", 1", "]"],
+        )
+
+    def test_it_skips_blocks_across_lines(self):
+        lines = ['foo = """[\n', "]\n", '""" + [1]\n']
+        self.assertEqual(
+            [list(self.parser.parse(line)) for line in lines],
+            [['foo = """[\n'], ["]\n"], ['""" + ', "[", "1", "]", "\n"]],
+        )
+
+    def test_it_skips_javascript_comments(self):
+        parser = condent.ParsesDelimiters("[]", language=condent.JAVASCRIPT)
+        lines = ["/* [\n", "*/ x = [1] // ]\n"]
+        self.assertEqual(
+            [list(parser.parse(line)) for line in lines],
+            [["/* [\n"], ["*/ x = ", "[", "1", "]", " // ]\n"]],
+        )
+
+    def test_it_skips_ruby_block_comments(self):
+        parser = condent.ParsesDelimiters("[]", language=condent.RUBY)
+        lines = ["=begin\n", "[\n", "=end\n", "x = [1]\n"]
+        self.assertEqual(
+            [list(parser.parse(line)) for line in lines],
+            [["=begin\n"], ["[\n"], ["=end\n"], ["x = ", "[", "1", "]", "\n"]],
+        )
+
+    def test_json_has_no_comments(self):
+        parser = condent.ParsesDelimiters("[]", language=condent.JSON)
+        self.assertEqual(
+            list(parser.parse('["#", [1]]')),
+            ["[", '"#", ', "[", "1", "]", "]"],
+        )
+
+
+class TestLanguage(TestCase):
+    def test_it_compiles_tables_once(self):
+        table = condent.PYTHON.table("[]")
+        self.assertIs(condent.PYTHON.table("]["), table)
+
+    def test_it_finds_languages_by_name(self):
+        self.assertIs(condent.language_for("foo.py", "ruby"), condent.RUBY)
+
+    def test_it_finds_languages_by_extension(self):
+        self.assertIs(condent.language_for("foo.js"), condent.JAVASCRIPT)
+        self.assertIs(condent.language_for("foo.json"), condent.JSON)
+
+    def test_it_defaults_to_python(self):
+        self.assertIs(condent.language_for("<stdin>"), condent.PYTHON)
+
 
 class TestCondenter(TestCase):
     def setUp(self):
         self.builder = mock.Mock()
-        self.config = mock.Mock()
+        self.config = mock.Mock(width=79)
         self.condenter = condent.Condenter(self.builder, self.config)
 
     def test_it_visits_tokens(self):
@@ -249,7 +321,7 @@ class TestCondenter(TestCase):
         left_token, items = mock.Mock(), []
         self.condenter.stack.append((left_token, items))
 
-        token = mock.Mock()
+        token = mock.Mock(content="foo")
         output = self.condenter.visit_NonDelimiter(token)
 
         self.assertEqual(items, [token])
@@ -260,6 +332,94 @@ class TestCondenter(TestCase):
         output = self.condenter.visit_NonDelimiter(token)
         self.assertEqual(output, token.content)
 
+    def test_it_streams_containers_which_do_not_fit(self):
+        self.config.configure_mock(symmetric_colons=True, trailing_comma=True)
+        condenter = condent.Condenter(
+            condent.LiteralBuilder(self.config), self.config,
+        )
+        item = "x" * 40
+
+        left = condent.LeftDelimiter(before="d = ", delimiter="[")
+        self.assertIsNone(condenter.visit(left))
+        self.assertIsNone(condenter.visit(condent.NonDelimiter(content="\n")))
+        line = condent.NonDelimiter(content="  " + item + ",\n")
+        self.assertIsNone(condenter.visit(line))
+        self.assertEqual(condenter.visit(line), "d = [\n    " + item + ",\n")
+        self.assertEqual(condenter.visit(line), "    " + item + ",\n")
+        self.assertEqual(
+            condenter.visit(condent.RightDelimiter(delimiter="]")),
+            "    " + item + ",\n]",
+        )
+        self.assertEqual(condenter.builder.stats, {"rebuilt" : 1})
+
+    def test_it_counts_unchanged_streamed_containers(self):
+        self.config.configure_mock(symmetric_colons=True, trailing_comma=True)
+        builder = condent.LiteralBuilder(self.config)
+        lines = ["    d = {\n"]
+        lines.extend("        'k{0}' : {0},\n".format(i) for i in range(20))
+        lines.append("    }\n")
+
+        got = "".join(condent.redent(lines, self.config, builder))
+
+        self.assertEqual(got, "".join(lines))
+        self.assertEqual(builder.stats, {"unchanged" : 1})
+
+    def test_it_reassembles_unfinished_streamed_containers(self):
+        self.config.configure_mock(symmetric_colons=True, trailing_comma=True)
+        condenter = condent.Condenter(
+            condent.LiteralBuilder(self.config), self.config,
+        )
+        item = "x" * 80
+        tokens = [
+            condent.LeftDelimiter(before="d = ", delimiter="["),
+            condent.NonDelimiter(content="  " + item + ",\n"),
+            condent.NonDelimiter(content="  " + item + ",\n"),
+        ]
+
+        got = condenter.redent([tokens])
+
+        self.assertEqual(
+            "".join(got), "d = [\n    {0},\n    {0},\n".format(item),
+        )
+
+    def test_it_streams_containers_with_dedented_items(self):
+        self.config.configure_mock(symmetric_colons=True, trailing_comma=True)
+        lines = [
+            "x = (1,'bar', 12345678901234567890, 1, 12345678901234567890,\n",
+            "    x.y, 12345678901234567890, 1, 12345678901234567890,\n",
+            "    'bar',\n",
+            "'bar',\n",
+            "    abcdefghijkl,1, foo,\n",
+            ")\n",
+        ]
+
+        got = "".join(condent.redent(lines, self.config))
+
+        items = [
+            "1", "'bar'", "12345678901234567890", "1", "12345678901234567890",
+            "x.y", "12345678901234567890", "1", "12345678901234567890",
+            "'bar'", "'bar'", "abcdefghijkl", "1", "foo",
+        ]
+        redented = "".join("    " + item + ",\n" for item in items)
+        self.assertEqual(got, "x = (\n" + redented + ")\n")
+        self.assertEqual(
+            got, "".join(condent.redent(lines, self.config, stream=False)),
+        )
+
+    def test_it_does_not_stream_when_told_not_to(self):
+        self.config.configure_mock(symmetric_colons=True, trailing_comma=True)
+        builder = condent.LiteralBuilder(self.config)
+        lines = ["d = [\n"] + ["    {0},\n".format("x" * 40)] * 3
+
+        got = condent.redent(lines, self.config, builder, stream=False)
+
+        self.assertEqual("".join(got), "".join(lines))
+        self.assertEqual(builder.stats, {})
+
+    def test_it_leaves_unmatched_right_delimiters_unchanged(self):
+        output = self.condenter.visit(condent.RightDelimiter(delimiter="]"))
+        self.assertEqual(output, "]")
+
     def test_it_can_fix_spaces_around_colons_non_symmetrically(self):
         pass
 
@@ -291,88 +451,594 @@ class TestLiteralBuilder(TestCase):
 
         builder.build_angle.assert_called_once_with(*args)
 
+    def test_it_returns_condented_containers_unchanged(self):
+        self.config.symmetric_colons = True
+        self.config.trailing_comma = True
+        self.config.width = 79
+        builder = condent.LiteralBuilder(self.config)
 
-class TestSingleLineItems(TestCase):
-    def setUp(self):
-        self.start = ""
-        self.left_delimiter = mock.Mock()
-        self.is_tuple = self.patchObject(
-            condent, "is_tuple", return_value=False,
+        got = builder.build("d = ", "{", ["'foo' : 'bar'"], "}")
+
+        self.assertEqual(got, "d = {'foo' : 'bar'}")
+        self.assertEqual(builder.stats, {"unchanged" : 1})
+
+    def test_it_counts_rebuilt_containers(self):
+        self.config.trailing_comma = True
+        self.config.width = 79
+        builder = condent.LiteralBuilder(self.config)
+
+        got = builder.build("d = ", "[", ["1,2"], "]")
+
+        self.assertEqual(got, "d = [1, 2]")
+        self.assertEqual(builder.stats, {"rebuilt" : 1})
+
+    def test_it_streams_items_that_do_not_fit(self):
+        self.config.trailing_comma = False
+        self.config.width = 79
+        builder = condent.LiteralBuilder(self.config)
+        items = ["x" * 40 + ", " + "y" * 40]
+
+        stream = builder.stream("    d = ", "(", items)
+
+        self.assertEqual(
+            stream.open(), "    d = (\n        {0},\n".format("x" * 40),
+        )
+        self.assertEqual(
+            stream.close(")"), "        {0}\n    )".format("y" * 40),
         )
 
-    def test_it_can_assemble_a_single_line_of_items(self):
-        items = ["foo", "bar", "baz", "quux", "spam"]
-        self.is_tuple.return_value = False
+    def test_it_splits_condented_streamed_lines_without_cleaning(self):
+        clean = mock.Mock()
+        stream = condent.StreamedLiteral("    d = ", "{", [], clean, " : ")
+
+        items = stream.items("        'a' : 1, 'b' : 2,\n")
+
+        self.assertEqual(items, ["'a' : 1", "'b' : 2"])
+        self.assertFalse(clean.called)
 
+    def test_it_cleans_streamed_lines_which_are_not_condented(self):
+        stream = condent.StreamedLiteral(
+            "d = ", "[", [], condent._clean_sequence_items,
+        )
+        self.assertEqual(stream.items("  1 ,2,\n"), ["1", "2"])
+
+    def test_it_does_not_stream_items_that_may_fit(self):
+        self.config.width = 79
+        builder = condent.LiteralBuilder(self.config)
+        self.assertIsNone(builder.stream("d = ", "[", ["1, 2"]))
+
+
+class TestIsCondented(TestCase):
+    def test_it_recognizes_a_single_line(self):
+        self.assertTrue(condent.is_condented("d = ", "[", ["1, 2"], "]"))
+
+    def test_it_recognizes_empty_containers(self):
+        self.assertTrue(condent.is_condented("d = ", "[", [], "]"))
+
+    def test_it_rejects_bad_separators(self):
+        self.assertFalse(condent.is_condented("d = ", "[", ["1,2"], "]"))
+        self.assertFalse(condent.is_condented("d = ", "[", ["1,  2"], "]"))
+        self.assertFalse(condent.is_condented("d = ", "[", ["1, 2,"], "]"))
+
+    def test_it_rejects_bad_text_before_the_container(self):
+        self.assertFalse(condent.is_condented("d=", "[", ["1, 2"], "]"))
+
+    def test_it_requires_a_comma_for_single_item_tuples(self):
+        self.assertTrue(condent.is_condented("d = ", "(", ["1,"], ")"))
+        self.assertFalse(condent.is_condented("d = ", "(", ["1"], ")"))
+
+    def test_it_checks_dict_separators(self):
+        self.assertTrue(
+            condent.is_condented("", "{", ["a : b"], "}", separator=" : "),
+        )
+        self.assertFalse(
+            condent.is_condented("", "{", ["a: b"], "}", separator=" : "),
+        )
+
+    def test_it_rejects_single_lines_which_are_too_wide(self):
+        items = [", ".join(["x" * 20] * 4)]
+        self.assertFalse(condent.is_condented("d = ", "[", items, "]"))
+
+    def test_it_recognizes_multiple_lines(self):
+        items = ["\n"] + ["        {0},\n".format("x" * 70)] * 2 + ["    "]
+        self.assertTrue(condent.is_condented("    d = ", "[", items, "]"))
+
+    def test_it_checks_the_trailing_comma_on_multiple_lines(self):
+        first, last = "x" * 70, "y" * 9
+        items = ["\n", "    {0},\n".format(first), "    {0}\n".format(last)]
+        self.assertTrue(condent.is_condented("", "[", items, "]", False))
+        self.assertFalse(condent.is_condented("", "[", items, "]"))
+
+    def test_it_rejects_multiple_lines_which_fit_on_one(self):
+        items = ["\n", "    1,\n", "    2,\n"]
+        self.assertFalse(condent.is_condented("d = ", "[", items, "]"))
+
+    def test_it_rejects_items_which_fit_on_one_inner_line(self):
+        items = ["\n", "    {0}, {0},\n".format("x" * 36)]
+        self.assertTrue(condent.is_condented("d = ", "[", items, "]"))
+
+    def test_it_rejects_bad_indentation(self):
+        items = ["\n", "  {0},\n".format("x" * 78)]
+        self.assertFalse(condent.is_condented("d = ", "[", items, "]"))
+
+
+class TestContainerLiteral(TestCase):
+    def test_it_fits_on_a_single_line(self):
         self.assertEqual(
-            condent.items(self.start, self.left_delimiter, items),
-            "foo, bar, baz, quux, spam",
+            condent.container_literal("d = ", "[", ["1", "2"], "]"),
+            "d = [1, 2]",
         )
 
-    def test_it_adds_a_comma_if_container_is_a_single_item_tuple(self):
-        items = ["foo"]
-        self.is_tuple.return_value = True
+    def test_it_splits_items_onto_an_inner_line(self):
+        items = ["x" * 36] * 2
+        self.assertEqual(
+            condent.container_literal("d = ", "[", items, "]"),
+            "d = [\n    " + ", ".join(items) + ",\n]",
+        )
 
+    def test_it_splits_items_onto_multiple_lines(self):
+        items = ["x" * 40] * 2
         self.assertEqual(
-            condent.items(self.start, self.left_delimiter, items), "foo,",
+            condent.container_literal("d = ", "[", items, "]"),
+            "d = [\n    " + ",\n    ".join(items) + ",\n]",
         )
-        self.is_tuple.assert_called_once_with(self.start, self.left_delimiter)
 
-    def test_it_does_not_add_a_comma_if_container_is_an_empty_tuple(self):
-        items = []
-        self.is_tuple.return_value = True
+    def test_it_has_a_configurable_width(self):
+        self.assertEqual(
+            condent.container_literal("d = ", "[", ["1", "2"], "]", width=9),
+            "d = [\n    1, 2,\n]",
+        )
 
+    def test_it_adds_one_comma_to_split_single_item_tuples(self):
+        item = "x" * 74
         self.assertEqual(
-            condent.items(self.start, self.left_delimiter, items), "",
+            condent.container_literal("d = ", "(", [item], ")"),
+            "d = (\n    " + item + ",\n)",
+        )
+
+    def test_it_adds_a_comma_if_container_is_a_single_item_tuple(self):
+        self.assertEqual(
+            condent.container_literal("d = ", "(", ["foo"], ")"), "d = (foo,)",
+        )
+
+    def test_it_does_not_add_a_comma_if_container_is_an_empty_tuple(self):
+        self.assertEqual(
+            condent.container_literal("d = ", "(", [], ")"), "d = ()",
         )
-        self.is_tuple.assert_called_once_with(self.start, self.left_delimiter)
 
     def test_it_does_not_add_a_comma_if_container_is_a_multi_item_tuple(self):
         items = ["foo", "bar", "baz", "quux", "spam"]
-        self.is_tuple.return_value = True
+        self.assertEqual(
+            condent.container_literal("d = ", "(", items, ")"),
+            "d = (foo, bar, baz, quux, spam)",
+        )
 
+    def test_it_splits_items_onto_multiple_lines_if_they_are_indented(self):
+        before = " " * 72 + "foo = "
+        items = ["1", "2", "3"]
         self.assertEqual(
-            condent.items(self.start, self.left_delimiter, items),
-            "foo, bar, baz, quux, spam",
+            condent.container_literal(before, "[", items, "]"),
+            before + "[\n" +
+            " " * 76 + (",\n" + " " * 76).join(items) + ",\n" +
+            " " * 72 + "]",
         )
-        self.is_tuple.assert_called_once_with(self.start, self.left_delimiter)
 
-    def test_even_if_the_line_is_really_long(self):
-        pass
+    def test_it_indents_more_if_before_is_indented(self):
+        before = " " * 7 + "foo_bar = "
+        items = ["a" * 39] * 2
+        indent = " " * 7 + " " * 4
+        self.assertEqual(
+            condent.container_literal(before, "[", items, "]"),
+            before + "[\n" +
+            indent + (",\n" + indent).join(items) + ",\n" +
+            " " * 7 + "]",
+        )
+
+    def test_it_can_leave_off_the_trailing_comma(self):
+        items = ["x" * 40] * 2
+        literal = condent.container_literal(
+            "d = ", "[", items, "]", trailing_comma=False,
+        )
+        self.assertEqual(
+            literal, "d = [\n    " + ",\n    ".join(items) + "\n]",
+        )
 
+    def test_it_does_not_split_empty_containers(self):
+        before = " " * 78 + "d = "
+        self.assertEqual(
+            condent.container_literal(before, "[", [], "]"), before + "[]",
+        )
 
-class TestMultiLineItems(TestCase):
+
+class TestUnifiedDiff(TestCase):
     def setUp(self):
-        self.items = ["a" * 39] * 2
-        self.start = ""
-        self.left_delimiter = mock.Mock()
+        self.config = mock.Mock(
+            symmetric_colons=True,
+            trailing_comma=True,
+            width=79,
+            language=None,
+        )
 
-    def test_it_splits_items_onto_multiple_lines_if_they_are_long(self):
+    def diff(self, lines, **kwargs):
+        return "".join(
+            condent.unified_diff(lines, self.config, "a", "b", **kwargs)
+        )
+
+    def test_it_outputs_nothing_for_unchanged_lines(self):
+        self.assertEqual(self.diff(["x = 1\n", "d = [1, 2]\n"]), "")
+
+    def test_it_diffs_changed_containers(self):
+        lines = ["x = 1\n", "d = [\n", "1,2]\n", "y = 2\n"]
         self.assertEqual(
-            condent.items(self.start, self.left_delimiter, self.items),
-            "    " + ",\n    ".join(self.items) + ",",
+            self.diff(lines),
+            dedent("""\
+            --- a
+            +++ b
+            @@ -1,4 +1,3 @@
+             x = 1
+            -d = [
+            -1,2]
+            +d = [1, 2]
+             y = 2
+            """),
         )
 
-    def test_it_splits_items_onto_multiple_lines_if_they_are_indented(self):
-        self.start = " " * 72 + "foo = "
-        items = ["1", "2", "3"]
+    def test_it_separates_distant_hunks(self):
+        lines = ["d = [1,2]\n"] + ["x\n"] * 7 + ["d = [3,4]\n"]
+        self.assertEqual(
+            self.diff(lines, context=1),
+            dedent("""\
+            --- a
+            +++ b
+            @@ -1,2 +1,2 @@
+            -d = [1,2]
+            +d = [1, 2]
+             x
+            @@ -8,2 +8,2 @@
+             x
+            -d = [3,4]
+            +d = [3, 4]
+            """),
+        )
 
+    def test_it_joins_nearby_hunks(self):
+        lines = ["d = [1,2]\n", "x\n", "x\n", "d = [3,4]\n"]
         self.assertEqual(
-            condent.items(self.start, self.left_delimiter, items),
-            " " * 76 + (",\n" + " " * 76).join(items) + ",",
+            self.diff(lines, context=1),
+            dedent("""\
+            --- a
+            +++ b
+            @@ -1,4 +1,4 @@
+            -d = [1,2]
+            +d = [1, 2]
+             x
+             x
+            -d = [3,4]
+            +d = [3, 4]
+            """),
         )
 
-    def test_it_indents_more_if_start_is_indented(self):
-        self.start = " " * 7 + "foo_bar = "
+    def test_it_marks_missing_newlines(self):
+        self.assertEqual(
+            self.diff(["d = [1,2]"]),
+            dedent("""\
+            --- a
+            +++ b
+            @@ -1 +1 @@
+            -d = [1,2]
+            \\ No newline at end of file
+            +d = [1, 2]
+            \\ No newline at end of file
+            """),
+        )
 
-        indent = " " * 7 + " " * 4
+    def test_it_diffs_files(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "foo.py")
+        with open(path, "w") as file:
+            file.write("d = [1,2]\n")
+
+        diff, stats = condent.diff_file(path, self.config)
+
+        self.assertIn("+d = [1, 2]\n", diff)
+        self.assertEqual(stats["rebuilt"], 1)
+
+
+class TestDocument(TestCase):
+    def setUp(self):
+        self.document = condent.Document("foo = [\n1,\n2]\nbar\n")
+
+    def test_it_splits_text_into_lines(self):
         self.assertEqual(
-            condent.items(self.start, self.left_delimiter, self.items),
-            indent + (",\n" + indent).join(self.items) + ",",
+            self.document.lines, ["foo = [\n", "1,\n", "2]\n", "bar\n"],
         )
 
-    def test_it_can_leave_off_the_trailing_comma(self):
-        items = condent.items(
-            self.start, self.left_delimiter, self.items, trailing_comma=False,
+    def test_it_can_replace_the_whole_text(self):
+        self.document.change("baz\r\nquux")
+        self.assertEqual(self.document.lines, ["baz\r\n", "quux"])
+
+    def test_it_applies_ranged_changes(self):
+        range = {
+            "start" : {"line" : 1, "character" : 1},
+            "end" : {"line" : 2, "character" : 1},
+        }
+        self.document.change(", 3,\n4", range=range)
+        self.assertEqual(self.document.text, "foo = [\n1, 3,\n4]\nbar\n")
+
+    def test_it_applies_changes_at_the_end(self):
+        range = {
+            "start" : {"line" : 4, "character" : 0},
+            "end" : {"line" : 4, "character" : 0},
+        }
+        self.document.change("baz\n", range=range)
+        self.assertEqual(self.document.lines[-2:], ["bar\n", "baz\n"])
+
+    def test_it_tracks_revisions(self):
+        self.document.change("baz", version=12)
+        self.assertEqual(
+            (self.document.revision, self.document.version), (1, 12),
+        )
+
+
+class TestMessages(TestCase):
+    def test_it_round_trips_messages(self):
+        output = StringIO()
+        condent.write_message(output, {"id" : 1})
+        condent.write_message(output, {"id" : 2})
+        output.seek(0)
+
+        self.assertEqual(condent.read_message(output), {"id" : 1})
+        self.assertEqual(condent.read_message(output), {"id" : 2})
+        self.assertIsNone(condent.read_message(output))
+
+
+class TestServer(TestCase):
+    def setUp(self):
+        self.config = mock.Mock(
+            symmetric_colons=True,
+            trailing_comma=True,
+            width=79,
+            language=None,
+        )
+
+    def serve(self, *messages):
+        input, output = StringIO(), StringIO()
+        for message in messages:
+            condent.write_message(input, message)
+        input.seek(0)
+
+        condent.Server(self.config, input, output).serve()
+
+        output.seek(0)
+        responses = {}
+        while True:
+            response = condent.read_message(output)
+            if response is None:
+                return responses
+            responses[response["id"]] = response
+
+    def open(self, text):
+        params = {"textDocument" : {"uri" : "file", "text" : text}}
+        return {"method" : "textDocument/didOpen", "params" : params}
+
+    def format(self, id, start, end):
+        range = {
+            "start" : {"line" : start, "character" : 0},
+            "end" : {"line" : end, "character" : 0},
+        }
+        params = {"textDocument" : {"uri" : "file"}, "range" : range}
+        method = "textDocument/rangeFormatting"
+        return {"id" : id, "method" : method, "params" : params}
+
+    def test_it_formats_ranges(self):
+        responses = self.serve(
+            self.open("x = 1\nd = {\n'foo':'bar'}\ny = 2\n"),
+            self.format(1, 1, 3),
+        )
+        range = {
+            "start" : {"line" : 1, "character" : 0},
+            "end" : {"line" : 3, "character" : 0},
+        }
+        self.assertEqual(
+            responses[1]["result"],
+            [{"range" : range, "newText" : "d = {'foo' : 'bar'}\n"}],
+        )
+
+    def test_it_returns_no_edits_for_formatted_ranges(self):
+        responses = self.serve(self.open("x = [1, 2]\n"), self.format(1, 0, 1))
+        self.assertEqual(responses[1]["result"], [])
+
+    def test_it_cancels_requests(self):
+        server = condent.Server(self.config, StringIO(), StringIO())
+        server.dispatch(self.open("x = [1,2]\n"))
+        server.dispatch(self.format(1, 0, 1))
+        server.dispatch(
+            {"method" : "$/cancelRequest", "params" : {"id" : 1}},
+        )
+        self.assertFalse(server.pending)
+        self.assertIn("-32800", server.output.getvalue())
+
+    def test_it_cancels_requests_made_stale_by_changes(self):
+        server = condent.Server(self.config, StringIO(), StringIO())
+        server.dispatch(self.open("x = [1,2]\n"))
+        server.dispatch(self.format(1, 0, 1))
+
+        params = {
+            "textDocument" : {"uri" : "file", "version" : 2},
+            "contentChanges" : [{"text" : "x = [1,2,3]\n"}],
+        }
+        change = {"method" : "textDocument/didChange", "params" : params}
+        server.dispatch(change)
+
+        self.assertFalse(server.pending)
+        self.assertIn("-32801", server.output.getvalue())
+
+    def test_it_keeps_formatting_after_unbalanced_ranges(self):
+        responses = self.serve(
+            self.open("x = [\n1,2,\n3]\ny = (1,2)\n"),
+            self.format(1, 1, 3),
+            self.format(2, 3, 4),
+        )
+        self.assertIn("result", responses[1])
+        self.assertEqual(responses[2]["result"][0]["newText"], "y = (1, 2)\n")
+
+    def test_it_keeps_formatting_after_failures(self):
+        redent = self.patchObject(condent, "redent", side_effect=IndexError)
+        responses = self.serve(self.open("x = [1,2]\n"), self.format(1, 0, 1))
+        self.assertEqual(responses[1]["error"]["code"], -32603)
+
+        redent.side_effect = None
+        redent.return_value = ["x = [1, 2]\n"]
+        responses = self.serve(self.open("x = [1,2]\n"), self.format(2, 0, 1))
+        self.assertEqual(responses[2]["result"][0]["newText"], "x = [1, 2]\n")
+
+    def test_it_stops_formatting_when_the_document_changes(self):
+        input, output = StringIO(), StringIO()
+        condent.write_message(input, self.open("a = [1]\nb = [2]\nc = [3]\n"))
+        condent.write_message(input, self.format(1, 0, 3))
+        input.seek(0)
+        server = condent.Server(self.config, input, output, check_every=1)
+
+        change = {
+            "textDocument" : {"uri" : "file", "version" : 2},
+            "contentChanges" : [{"text" : "x = 1\n"}],
+        }
+        seen = []
+
+        def redent(lines, *args, **kwargs):
+            for line in lines:
+                seen.append(line)
+                if len(seen) == 1:
+                    server.lsp_textDocument_didChange(None, change)
+                yield line
+
+        self.patchObject(condent, "redent", side_effect=redent)
+        server.serve()
+
+        output.seek(0)
+        response = condent.read_message(output)
+        self.assertEqual(response["error"]["code"], -32801)
+        self.assertEqual(seen, ["a = [1]\n"])
+
+    def test_it_errors_when_formatting_unopened_documents(self):
+        responses = self.serve(self.format(1, 0, 1))
+        self.assertEqual(responses[1]["error"]["code"], -32602)
+
+    def test_it_ignores_changes_to_unopened_documents(self):
+        params = {
+            "textDocument" : {"uri" : "file", "version" : 2},
+            "contentChanges" : [{"text" : "x = 1\n"}],
+        }
+        responses = self.serve(
+            {"method" : "textDocument/didChange", "params" : params},
+            self.open("x = [1,2]\n"),
+            self.format(1, 0, 1),
+        )
+        self.assertEqual(responses[1]["result"][0]["newText"], "x = [1, 2]\n")
+
+    def test_it_errors_for_unknown_requests(self):
+        responses = self.serve({"id" : 1, "method" : "foo/bar"})
+        self.assertEqual(responses[1]["error"]["code"], -32601)
+
+
+class TestWatching(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.config = mock.Mock(
+            symmetric_colons=True,
+            trailing_comma=True,
+            width=79,
+            language=None,
         )
-        self.assertEqual(items, "    " + ",\n    ".join(self.items))
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as file:
+            file.write(content)
+        return path
+
+    def read(self, path):
+        with open(path) as file:
+            return file.read()
+
+    def test_walk_finds_files_with_extensions(self):
+        os.mkdir(os.path.join(self.directory, "sub"))
+        foo = self.write("foo.py", "")
+        bar = self.write(os.path.join("sub", "bar.py"), "")
+        self.write("baz.txt", "")
+
+        directories, files = condent.walk([self.directory])
+
+        self.assertEqual(files, set([foo, bar]))
+        self.assertIn(os.path.join(self.directory, "sub"), directories)
+
+    def test_walk_includes_explicit_files(self):
+        baz = self.write("baz.txt", "")
+        self.assertEqual(condent.walk([baz]), (set(), set([baz])))
+
+    def test_poller_sees_changed_and_new_files(self):
+        foo = self.write("foo.py", "")
+        poller = condent.Poller([self.directory], delay=0)
+        self.assertEqual(poller.poll(), set())
+
+        self.write("foo.py", "changed")
+        bar = self.write("bar.py", "")
+        os.utime(self.directory, (0, 0))
+
+        self.assertEqual(poller.poll(), set([foo, bar]))
+        self.assertEqual(poller.poll(), set())
+
+    def test_inotify_sees_changed_files(self):
+        try:
+            inotify = condent.Inotify([self.directory], delay=0)
+        except OSError:
+            self.skipTest("inotify is not available")
+        foo = self.write("foo.py", "")
+        self.write("baz.txt", "")
+        self.assertEqual(set(inotify.read()), set([foo]))
+
+    def test_watcher_redents_changed_files(self):
+        foo = self.write("foo.py", "d = [1,2]\n")
+        watcher = condent.Watcher([self.directory], self.config)
+
+        self.assertTrue(watcher.redent(foo))
+        self.assertEqual(self.read(foo), "d = [1, 2]\n")
+
+    def test_watcher_ignores_its_own_writes(self):
+        foo = self.write("foo.py", "d = [1,2]\n")
+        watcher = condent.Watcher([self.directory], self.config)
+        watcher.redent(foo)
+
+        with mock.patch.object(condent, "redent") as redent:
+            self.assertFalse(watcher.redent(foo))
+        self.assertFalse(redent.called)
+
+    def test_watcher_leaves_unclosed_containers_unchanged(self):
+        content = "NAMES = [\n" + '    "name",\n' * 12 + "def main():\n"
+        foo = self.write("foo.py", content)
+        watcher = condent.Watcher([self.directory], self.config)
+
+        self.assertFalse(watcher.redent(foo))
+        self.assertEqual(self.read(foo), content)
+
+    def test_watcher_keeps_watching_after_failures(self):
+        bad = self.write("bad.py", "d = {1: 2, 3}\n")
+        good = self.write("good.py", "d = [1,2]\n")
+        errors = StringIO()
+        watcher = condent.Watcher([self.directory], self.config, errors=errors)
+        watcher.changes = mock.Mock()
+        watcher.changes.changes.return_value = [set([bad, good])]
+
+        watcher.watch()
+
+        self.assertEqual(self.read(bad), "d = {1: 2, 3}\n")
+        self.assertEqual(self.read(good), "d = [1, 2]\n")
+        self.assertIn(bad, errors.getvalue())
+        self.assertNotIn(bad, watcher.known)
+
+    def test_watcher_ignores_deleted_files(self):
+        watcher = condent.Watcher([self.directory], self.config)
+        path = os.path.join(self.directory, "gone.py")
+        self.assertFalse(watcher.redent(path))
@@ -14,6 +14,8 @@ class Config(object):
     symmetric_colons = True
     trailing_comma = True
     single_line_trailing_comma = False
+    width = 79
+    language = None
 
 
 class TestExamples(unittest.TestCase):
@@ -45,6 +47,28 @@ class TestExamples(unittest.TestCase):
                     self.dump(example, got, expect)
                     raise
 
+    def test_it_leaves_redented_examples_unchanged(self):
+        config = Config()
+        builder = LiteralBuilder(config)
+        delimiters = DELIMITERS.keys() + DELIMITERS.values()
+        parser = ParsesDelimiters(delimiters)
+
+        with open(REDENTED_FILE) as expected:
+            expected.readline()  # remove modeline
+            expected = [e.splitlines(True) for e in expected.read().split(SEP)]
+
+        for expect in expected:
+            tokens = (
+                tokenize(parser.parse(line), DELIMITERS, DELIMITERS.values())
+                for line in expect
+            )
+
+            got = "".join(Condenter(builder, config).redent(tokens))
+            self.assertEqual(got, "".join(expect))
+
+        stats = builder.stats
+        self.assertGreater(stats["unchanged"], stats["rebuilt"])
+
     def dump(self, example, got, expected):
         print textwrap.dedent("""
 